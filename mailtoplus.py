@@ -22,21 +22,45 @@ To control Mail.app, an AppleScript is launched.
    limitations under the License.
 """
 
+import atexit
 import base64
+from contextlib import contextmanager
+import copy
+import ctypes
+import ctypes.util
+import errno
+import hashlib
+import httplib
 import logging
+import logging.handlers
 import os.path
 import platform
+import Queue
 import re
 import shutil
+import socket
 import ssl
-from subprocess import Popen, PIPE, call
+from subprocess import Popen, PIPE
+import threading
 import traceback
 import sys
 import tempfile
 import time
+import urllib
 import urllib2
 import urlparse
 import yaml
+import zlib
+
+try:
+    import fcntl
+except ImportError: # not on Windows
+    fcntl = None
+
+try:
+    import brotli
+except ImportError: # optional, only adds 'br' to Accept-Encoding
+    brotli = None
 
 __author__ = "Philipp Adelt"
 __copyright__ = "Copyright 2014-2018"
@@ -53,6 +77,44 @@ import tkMessageBox
 
 scheme = 'mailtoplus'
 
+# Key holding a base64url encoded, deflate compressed payload
+# instead of plain key/value pairs.
+compressed_key = 'z'
+# Prefix for keys placed before the first 'to=' that every email inherits.
+default_prefix = 'default.'
+# Resource limits of the parser, overridable in the 'options' section.
+default_limits = {
+    'max_uri_length': 2 * 1024 * 1024,
+    'max_payload_length': 16 * 1024 * 1024, # inflated 'z=' payload
+    'max_emails': 1000,
+    'max_attachments': 100, # per email, including defaults
+    'max_field_length': 4 * 1024 * 1024, # each decoded value
+}
+# Block size for copying local attachments that cannot be linked.
+copy_chunk = 1024 * 1024
+# Number of quoted values URI building keeps for reuse.
+quote_cache_size = 1024
+# Transfer compressions understood for url attachments.
+accept_encoding = 'gzip, deflate, br' if brotli else 'gzip, deflate'
+# ioctl to clone a file on Linux (btrfs, XFS), see ioctl_ficlone(2).
+FICLONE = 0x40049409
+# Seconds to wait for a speculative HEAD request.
+prefetch_timeout = 10
+# Upper bounds (seconds) of the stage latency histogram buckets.
+latency_buckets = (0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 300)
+# Chunk size used when inflating a compressed payload.
+decompress_chunk = 4096
+
+def process_umask():
+    # The umask can only be read by setting it, which affects every
+    # thread creating files at that moment, so this runs once on import.
+    umask = os.umask(0)
+    os.umask(umask)
+    return umask
+
+# Mode of the metrics files, which e.g. node_exporter reads as another user.
+file_mode = 0666 & ~process_umask()
+
 class WrongSchemeException(Exception):
     pass
 
@@ -80,16 +142,138 @@ def fileurl2path(fileurl):
 def path2fileurl(path):
     return "file://{0}".format(path).replace("\\", "/")
 
+class QueueHandler(logging.Handler):
+    """Puts log records on a queue instead of writing them, so logging
+    never waits for a file or socket. The counterpart is QueueListener.
+    """
+    def __init__(self, queue):
+        logging.Handler.__init__(self)
+        self.queue = queue
+
+    def prepare(self, record):
+        # Render message and traceback now, the arguments may have
+        # changed by the time the listener thread gets to the record.
+        # Other handlers of the logger still get the original record.
+        msg = self.format(record)
+        record = copy.copy(record)
+        record.msg = msg
+        record.args = None
+        record.exc_info = None
+        record.exc_text = None
+        return record
+
+    def emit(self, record):
+        try:
+            self.queue.put_nowait(self.prepare(record))
+        except Exception:
+            self.handleError(record)
+
+class QueueListener(object):
+    """Background thread passing every queued record to the actual
+    handlers, subject to their levels and filters.
+    """
+    def __init__(self, queue, *handlers):
+        self.queue = queue
+        self.handlers = list(handlers)
+        self.thread = None
+
+    def add_handler(self, handler):
+        self.handlers.append(handler)
+
+    def start(self):
+        self.thread = threading.Thread(target=self.monitor, name="mailtoplus-logging")
+        self.thread.daemon = True
+        self.thread.start()
+
+    def monitor(self):
+        while True:
+            record = self.queue.get()
+            if record is None:
+                break
+            for handler in self.handlers:
+                if record.levelno >= handler.level:
+                    handler.handle(record)
+
+    def stop(self):
+        """Processes everything still queued, then ends the thread."""
+        if self.thread:
+            self.queue.put(None)
+            self.thread.join()
+            self.thread = None
+        for handler in self.handlers:
+            handler.flush()
+
+def syslog_address():
+    for path in ('/var/run/syslog', '/dev/log'):
+        if os.path.exists(path):
+            return path
+    return ('localhost', logging.handlers.SYSLOG_UDP_PORT)
+
+def reflink(source, destination):
+    """Creates destination as a copy-on-write clone of source, sharing all
+    data blocks. Returns False where the platform or file system cannot.
+    """
+    if platform.system() == 'Darwin':
+        libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        if not hasattr(libc, 'clonefile'): # before MacOS 10.12
+            return False
+        encoding = sys.getfilesystemencoding()
+        if isinstance(source, unicode):
+            source = source.encode(encoding)
+        if isinstance(destination, unicode):
+            destination = destination.encode(encoding)
+        return libc.clonefile(source, destination, 0) == 0
+    if fcntl and platform.system() == 'Linux':
+        with open(source, 'rb') as src:
+            with open(destination, 'wb') as dst:
+                try:
+                    fcntl.ioctl(dst.fileno(), FICLONE, src.fileno())
+                    return True
+                except IOError:
+                    pass
+        os.remove(destination)
+    return False
+
 def initial_logging():
     log = logging.getLogger(__name__)
-    ch = logging.StreamHandler()
-    ch.setLevel(logging.INFO)
-    formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
-    ch.setFormatter(formatter)
-    log.addHandler(ch)
+    log.addHandler(logging.NullHandler()) # until start_logging, e.g. when used as a library
+    return log
+
+def initial_syslog():
+    """Messages to this logger also go to syslog, replacing the 'logger'
+    command line tool.
+    """
+    log = logging.getLogger(__name__ + '.syslog')
+    log.setLevel(logging.INFO)
     return log
 
 logger = initial_logging()
+syslogger = initial_syslog()
+log_listener = None
+
+def start_logging():
+    """Starts the logging thread with console and syslog output on first
+    use and returns its QueueListener. Records of logger and its children
+    are written on that thread.
+    """
+    global log_listener
+    if not log_listener:
+        ch = logging.StreamHandler()
+        ch.setLevel(logging.INFO)
+        formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+        ch.setFormatter(formatter)
+        try:
+            sh = logging.handlers.SysLogHandler(address=syslog_address())
+        except socket.error:
+            sh = logging.handlers.SysLogHandler()
+        sh.setFormatter(logging.Formatter('mailtoplus: %(message)s'))
+        sh.addFilter(logging.Filter(syslogger.name))
+        log_listener = QueueListener(Queue.Queue(), ch, sh)
+        logger.addHandler(QueueHandler(log_listener.queue))
+        atexit.register(log_listener.stop)
+    if not log_listener.thread:
+        log_listener.start()
+    return log_listener
 
 class ConfigManager():
     def __init__(self):
@@ -148,7 +332,11 @@ class ConfigManager():
         options = config.get('options', None)
         if options and isinstance(options, dict):
             for key, value in options.items():
-                if isinstance(key, basestring) and isinstance(value, basestring):
+                if not isinstance(key, basestring):
+                    continue
+                if isinstance(value, basestring):
+                    self.configuration['options'][key] = value
+                elif key in default_limits and isinstance(value, (int, long)) and not isinstance(value, bool):
                     self.configuration['options'][key] = value
 
     def setup_logging(self):
@@ -160,7 +348,8 @@ class ConfigManager():
         """
         logfile = self.configuration['options'].get('logfile', None)
         if logfile and isinstance(logfile, basestring):
-            ch = logging.FileHandler(logfile)
+            # Opened lazily by the logging thread on the first record.
+            ch = logging.FileHandler(logfile, delay=True)
 
             level = self.configuration['options'].get('loglevel', None)
             if not level:
@@ -175,7 +364,9 @@ class ConfigManager():
                 }.get(level, logging.INFO))
             formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
             ch.setFormatter(formatter)
-            logger.addHandler(ch)
+            if ch.level < logger.getEffectiveLevel():
+                logger.setLevel(ch.level)
+            start_logging().add_handler(ch)
 
 
     def write_configuration(self, filelike):
@@ -221,12 +412,39 @@ class ConfigManager():
             'action': action,
         }
 
+    def get_limits(self):
+        """The parser limits from the options, falling back to default_limits."""
+        limits = dict(default_limits)
+        for key in default_limits:
+            value = self.configuration['options'].get(key, None)
+            if value is None:
+                continue
+            try:
+                limits[key] = int(value)
+            except ValueError:
+                logger.warning("Ignoring option %s, '%s' is not a number.", key, value)
+        return limits
+
+    def get_cachedir(self):
+        """The content-addressed attachment store, option 'cachedir'."""
+        return self.configuration['options'].get('cachedir',
+            os.path.join(os.path.expanduser("~"), ".mailtoplus-cache"))
+
+    def get_metricsfile(self):
+        """The metrics store, overridable with the option 'metricsfile'."""
+        return self.configuration['options'].get('metricsfile',
+            os.path.join(os.path.expanduser("~"), ".mailtoplus-metrics.yaml"))
+
     def get_tempdir(self):
         if not self.tempdir:
             self.tempdir = os.path.join(os.path.expanduser("~"), ".mailtoplus-temp")
         return self.tempdir
 
     def get_tempfilename(self, filename):
+        # The name comes from the link, it must not leave the temp dir.
+        filename = os.path.basename(filename)
+        if filename in ('', '.', '..'):
+            raise MalformedAttachmentException("Attachment name '{0}' is not a file name.".format(filename))
         directory = None
         while not directory or os.path.exists(directory):
             self.tempfile_counter += 1
@@ -244,20 +462,401 @@ class ConfigManager():
             os.rmdir(os.path.dirname(tfile))
         self.tempfiles = []
 
-class Mailtoplus():
+class RunMetrics():
+    """Measurements of a single run, merged into the MetricsStore at the end."""
     def __init__(self):
+        self.latencies = {}
+        self.downloads = {}
+        self.errors = {}
+        self.cache = {'hit': 0, 'miss': 0}
+        self.shared = 0
+
+    def observe(self, stage, seconds):
+        self.latencies.setdefault(stage, []).append(seconds)
+
+    @contextmanager
+    def timed(self, stage):
+        """Observes the duration of the block unless it raises."""
+        started = time.time()
+        yield
+        self.observe(stage, time.time() - started)
+
+    def add_download(self, region, nbytes, seconds):
+        d = self.downloads.setdefault(region, {'bytes': 0, 'seconds': 0.0, 'count': 0})
+        d['bytes'] += nbytes
+        d['seconds'] += seconds
+        d['count'] += 1
+
+    def count_error(self, exception):
+        name = exception.__class__.__name__
+        self.errors[name] = self.errors.get(name, 0) + 1
+
+    def count_cache(self, hit):
+        """Counts a content store lookup for a sha256-pinned attachment."""
+        self.cache['hit' if hit else 'miss'] += 1
+
+    def count_shared(self):
+        """Counts an attachment reused from an earlier email of the run."""
+        self.shared += 1
+
+class MetricsStore():
+    """Cumulative metrics across runs, kept as YAML in a local file.
+    Several mailtoplus processes may finish at the same time, so every
+    update happens under an exclusive lock and replaces the file atomically.
+    """
+    def __init__(self, filename):
+        self.filename = filename
+
+    def empty(self):
+        return {'latency': {}, 'downloads': {}, 'errors': {}, 'cache': {'hit': 0, 'miss': 0}, 'shared': 0}
+
+    def read(self):
+        try:
+            with open(self.filename, 'r') as f:
+                data = yaml.safe_load(f)
+        except IOError:
+            return self.empty()
+        except yaml.YAMLError:
+            logger.warning("Metrics store %s is corrupt, starting over.", self.filename)
+            return self.empty()
+        if not isinstance(data, dict):
+            return self.empty()
+        for key, value in self.empty().items():
+            if not isinstance(data.get(key), type(value)):
+                data[key] = value
+        return data
+
+    @contextmanager
+    def locked(self):
+        with open(self.filename + '.lock', 'a') as lock:
+            if fcntl:
+                fcntl.flock(lock.fileno(), fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                if fcntl:
+                    fcntl.flock(lock.fileno(), fcntl.LOCK_UN)
+
+    def merge(self, run, textfile=None):
+        """Adds the RunMetrics to the store and returns the new totals.
+        The optional Prometheus textfile is rewritten under the same lock,
+        so a slower run never replaces it with older totals.
+        """
+        with self.locked():
+            data = self.read()
+
+            for stage, observations in run.latencies.items():
+                h = data['latency'].get(stage)
+                if not isinstance(h, dict) or len(h.get('buckets', [])) != len(latency_buckets) + 1:
+                    h = data['latency'][stage] = {'buckets': [0] * (len(latency_buckets) + 1), 'sum': 0.0, 'count': 0}
+                for seconds in observations:
+                    index = len(latency_buckets)
+                    for i, bound in enumerate(latency_buckets):
+                        if seconds <= bound:
+                            index = i
+                            break
+                    h['buckets'][index] += 1
+                    h['sum'] += seconds
+                    h['count'] += 1
+
+            for region, d in run.downloads.items():
+                total = data['downloads'].setdefault(region, {'bytes': 0, 'seconds': 0.0, 'count': 0})
+                for key in ('bytes', 'seconds', 'count'):
+                    total[key] += d[key]
+
+            for name, count in run.errors.items():
+                data['errors'][name] = data['errors'].get(name, 0) + count
+
+            for key, count in run.cache.items():
+                data['cache'][key] = data['cache'].get(key, 0) + count
+
+            data['shared'] += run.shared
+
+            self.write(self.filename, yaml.safe_dump(data, default_flow_style=False))
+            if textfile:
+                self.write_prometheus(data, textfile)
+        return data
+
+    def write(self, filename, content):
+        directory = os.path.dirname(os.path.abspath(filename))
+        fd, tname = tempfile.mkstemp(dir=directory, prefix='.mailtoplus-')
+        try:
+            with os.fdopen(fd, 'w') as f:
+                if hasattr(os, 'fchmod'): # mkstemp creates 0600
+                    os.fchmod(f.fileno(), file_mode)
+                f.write(content)
+            os.rename(tname, filename)
+        except:
+            os.remove(tname)
+            raise
+
+    def __label(self, value):
+        return unicode(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+    def prometheus(self, data):
+        """Renders the totals in the Prometheus text exposition format."""
+        lines = [
+            '# HELP mailtoplus_stage_duration_seconds Duration of the processing stages.',
+            '# TYPE mailtoplus_stage_duration_seconds histogram',
+        ]
+        for stage, h in sorted(data['latency'].items()):
+            cumulative = 0
+            for bound, count in zip([repr(float(b)) for b in latency_buckets] + ['+Inf'], h['buckets']):
+                cumulative += count
+                lines.append(u'mailtoplus_stage_duration_seconds_bucket{{stage="{0}",le="{1}"}} {2}'.format(
+                    self.__label(stage), bound, cumulative))
+            lines.append(u'mailtoplus_stage_duration_seconds_sum{{stage="{0}"}} {1}'.format(self.__label(stage), float(h['sum'])))
+            lines.append(u'mailtoplus_stage_duration_seconds_count{{stage="{0}"}} {1}'.format(self.__label(stage), h['count']))
+
+        for metric, key, text in (
+                ('mailtoplus_download_bytes_total', 'bytes', 'Bytes downloaded per region.'),
+                ('mailtoplus_download_seconds_total', 'seconds', 'Time spent downloading per region.'),
+                ('mailtoplus_downloads_total', 'count', 'Number of downloads per region.')):
+            lines.append('# HELP {0} {1}'.format(metric, text))
+            lines.append('# TYPE {0} counter'.format(metric))
+            for region, d in sorted(data['downloads'].items()):
+                lines.append(u'{0}{{region="{1}"}} {2}'.format(metric, self.__label(region), d[key]))
+
+        lines.append('# HELP mailtoplus_errors_total Failed runs by exception class.')
+        lines.append('# TYPE mailtoplus_errors_total counter')
+        for name, count in sorted(data['errors'].items()):
+            lines.append(u'mailtoplus_errors_total{{exception="{0}"}} {1}'.format(self.__label(name), count))
+
+        lines.append('# HELP mailtoplus_cache_requests_total Content store lookups for pinned attachments by result.')
+        lines.append('# TYPE mailtoplus_cache_requests_total counter')
+        for result, count in sorted(data['cache'].items()):
+            lines.append(u'mailtoplus_cache_requests_total{{result="{0}"}} {1}'.format(self.__label(result), count))
+
+        lines.append('# HELP mailtoplus_shared_attachments_total Attachments reused from an earlier email of the same link.')
+        lines.append('# TYPE mailtoplus_shared_attachments_total counter')
+        lines.append('mailtoplus_shared_attachments_total {0}'.format(data['shared']))
+
+        return u'\n'.join(lines) + u'\n'
+
+    def write_prometheus(self, data, filename):
+        """Writes a file for node_exporter's textfile collector."""
+        self.write(filename, self.prometheus(data).encode('utf-8'))
+
+def record_metrics(config, metrics):
+    """Merges the RunMetrics into the store and refreshes the optional
+    Prometheus textfile (option 'metrics_textfile'). Never fails the run.
+    """
+    try:
+        store = MetricsStore(config.get_metricsfile())
+        store.merge(metrics, config.configuration['options'].get('metrics_textfile', None))
+    except (IOError, OSError), e:
+        logger.warning("Could not record metrics: %s", e)
+
+class ContentDecoder():
+    """Undoes the Content-Encoding of a response chunk by chunk."""
+    def __init__(self, encoding):
+        self.encoding = (encoding or 'identity').strip().lower()
+        self.obj = None
+        if self.encoding in ('gzip', 'x-gzip'):
+            self.obj = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        elif self.encoding == 'br' and brotli:
+            self.obj = brotli.Decompressor()
+        elif self.encoding not in ('identity', 'deflate'):
+            raise DownloadException("Unsupported Content-Encoding '{0}'.".format(encoding))
+
+    def decompress(self, chunk):
+        """Yields the decoded data in pieces of at most copy_chunk bytes
+        (brotli: unbounded), so a small chunk cannot inflate in memory.
+        """
+        if self.encoding == 'identity':
+            yield chunk
+            return
+        if self.obj is None:
+            # 'deflate' is meant to be zlib-wrapped, but some servers send
+            # raw deflate. A zlib header is divisible by 31.
+            wrapped = len(chunk) >= 2 and ord(chunk[0]) & 0x0F == 8 and (ord(chunk[0]) << 8 | ord(chunk[1])) % 31 == 0
+            self.obj = zlib.decompressobj(zlib.MAX_WBITS if wrapped else -zlib.MAX_WBITS)
+        try:
+            if self.encoding == 'br':
+                yield self.obj.process(chunk) if hasattr(self.obj, 'process') else self.obj.decompress(chunk)
+                return
+            data = self.obj.decompress(chunk, copy_chunk)
+            yield data
+            while self.obj.unconsumed_tail:
+                yield self.obj.decompress(self.obj.unconsumed_tail, copy_chunk)
+        except zlib.error, e:
+            raise DownloadException("Could not decode {0} content: {1}".format(self.encoding, e))
+        except Exception, e:
+            if brotli and isinstance(e, brotli.error):
+                raise DownloadException("Could not decode {0} content: {1}".format(self.encoding, e))
+            raise
+
+    def flush(self):
+        if self.obj is None or self.encoding == 'br':
+            return ''
+        try:
+            return self.obj.flush()
+        except zlib.error, e:
+            raise DownloadException("Could not decode {0} content: {1}".format(self.encoding, e))
+
+class ContentStore():
+    """Attachments pinned by SHA-256, kept across runs. Files are stored
+    under their hash, so identical content from different URLs is kept
+    once and a known hash needs no download at all.
+    """
+    def __init__(self, directory):
+        self.directory = directory
+
+    def path(self, digest):
+        return os.path.join(self.directory, digest[:2], digest)
+
+    def lookup(self, digest):
+        path = self.path(digest)
+        return path if os.path.isfile(path) else None
+
+    def add(self, filename, digest):
+        """Adds a verified file, as a hardlink where possible."""
+        path = self.path(digest)
+        if os.path.isfile(path):
+            return path
+        if not os.path.isdir(os.path.dirname(path)):
+            try:
+                os.makedirs(os.path.dirname(path))
+            except OSError, e:
+                if e.errno != errno.EEXIST:
+                    raise
+        # Concurrent runs may add the same content, so rename into place.
+        tname = "{0}.{1}.tmp".format(path, os.getpid())
+        try:
+            try:
+                os.link(filename, tname)
+            except OSError:
+                shutil.copyfile(filename, tname)
+            os.rename(tname, path)
+        except (IOError, OSError):
+            if os.path.exists(tname): # e.g. a disk full during the copy
+                os.remove(tname)
+            raise
+        return path
+
+class Mailtoplus():
+    def __init__(self, limits=None):
         self.re_pair = re.compile(r"^([^&=]+)=([^&=]+)$")
+        self.re_hash = re.compile(r"^(.*),sha256:([0-9a-fA-F]{64})$")
+        self.re_unsafe = re.compile(r"[^A-Za-z0-9_.\-]")
+        self.re_digest = re.compile(r"^[0-9a-fA-F]{64}$")
+        self.quoted = {}
+        self.limits = dict(default_limits)
+        if limits:
+            self.limits.update(limits)
 
     def __decode_addresses(self, addresses):
         return map(self.__decode, addresses.split(","))
 
     def __decode(self, text):
         unquoted = urllib2.unquote(text)
+        if len(unquoted) > self.limits['max_field_length']:
+            raise MalformedUriException("A value is longer than {0} bytes.".format(self.limits['max_field_length']))
         try:
             return unquoted.decode("utf-8")
         except UnicodeDecodeError, e:
             raise MalformedUriException("The unquoting '%s' did not yield a valid UTF-8 encoded string." % text)
 
+    def __inflater_finished(self, inflater):
+        # zlib on Python 2 has no 'eof' flag, so probe a copy with a single
+        # byte: only a finished stream hands it back as unused data.
+        probe = inflater.copy()
+        try:
+            probe.decompress('\x00')
+        except zlib.error:
+            return False
+        return probe.unused_data == '\x00'
+
+    def __iter_compressed(self, payload):
+        """Inflates a base64url encoded deflate stream piece by piece and
+        yields its '&'-delimited elements as they become available.
+        """
+        try:
+            # Padding is optional in the URI.
+            data = base64.urlsafe_b64decode(payload + '=' * (-len(payload) % 4))
+        except (TypeError, ValueError), e:
+            raise MalformedUriException("Compressed payload is not valid base64url: %s" % e)
+
+        inflater = zlib.decompressobj()
+        total = 0
+        pieces = [] # of the element not yet terminated by '&'
+        try:
+            for start in xrange(0, len(data), decompress_chunk):
+                inflated = inflater.decompress(data[start:start + decompress_chunk])
+                total += len(inflated)
+                if total > self.limits['max_payload_length']:
+                    raise MalformedUriException("Compressed payload inflates to more than {0} bytes.".format(
+                        self.limits['max_payload_length']))
+                parts = inflated.split("&")
+                if len(parts) > 1:
+                    pieces.append(parts[0])
+                    yield ''.join(pieces)
+                    for element in parts[1:-1]:
+                        yield element
+                    pieces = []
+                pieces.append(parts[-1])
+        except zlib.error, e:
+            raise MalformedUriException("Compressed payload could not be inflated: %s" % e)
+        if inflater.unused_data or not self.__inflater_finished(inflater):
+            raise MalformedUriException("Compressed payload is truncated or has trailing data.")
+        yield ''.join(pieces)
+
+    def __iter_split(self, rest):
+        # Like rest.split("&"), but without building a list of all elements.
+        start = 0
+        end = rest.find("&")
+        while end != -1:
+            yield rest[start:end]
+            start = end + 1
+            end = rest.find("&", start)
+        yield rest[start:]
+
+    def __iter_elements(self, rest):
+        """Yields the raw key=value elements of the URI data, transparently
+        inflating a compressed payload.
+        """
+        prefix = '%s=' % compressed_key
+        if rest.startswith(prefix):
+            payload = rest[len(prefix):]
+            if "&" in payload.rstrip("&"):
+                raise MalformedUriException("A compressed payload must be the only element of the URI.")
+            return self.__iter_compressed(payload.rstrip("&"))
+        return self.__iter_split(rest)
+
+    def __parse_field(self, target, key, value, defaults={}):
+        """Decodes a single non-'to' key into the email (or defaults) dict."""
+        if key in set(["cc", "bcc"]):
+            target[key] = self.__decode_addresses(value)
+
+        elif key in set(["subject", "body"]):
+            target[key] = self.__decode(value)
+
+        elif key == 'attachment':
+            try:
+                method, source, attachmentname = value.split(',', 2)
+                if method not in ('local', 'url'):
+                    raise MalformedAttachmentException("Attachment '%s' specifies an unknown method." % value)
+                if not 'attachment' in target:
+                    target['attachment'] = []
+                elif target['attachment'] is defaults.get('attachment'):
+                    # Default attachments are kept, but the list is per email.
+                    target['attachment'] = list(target['attachment'])
+                if len(target['attachment']) >= self.limits['max_attachments']:
+                    raise MalformedUriException("More than {0} attachments in one email.".format(
+                        self.limits['max_attachments']))
+                att = {'method': method, 'source': self.__decode(source)}
+                pinned = self.re_hash.match(attachmentname)
+                if pinned:
+                    attachmentname = pinned.group(1)
+                    att['sha256'] = pinned.group(2).lower()
+                att['attachmentname'] = self.__decode(attachmentname)
+                target['attachment'].append(att)
+            except ValueError, e:
+                raise MalformedAttachmentException("Attachment '%s' has not the expected form." % value)
+
+        else:
+            raise MalformedUriException("Found unknown key '%s'" % key)
+
     def parse_uri(self, uri):
         emails = []
         if not uri:
@@ -266,10 +865,14 @@ class Mailtoplus():
         if not uri.startswith('%s:' % scheme):
             raise WrongSchemeException("URI has to start with '%s:'" % scheme)
 
+        if len(uri) > self.limits['max_uri_length']:
+            raise MalformedUriException("URI is longer than {0} characters.".format(self.limits['max_uri_length']))
+
         rest = uri.split(":", 1)[1]
 
+        defaults = {}
         email = None
-        for element in rest.split("&"):
+        for element in self.__iter_elements(rest):
             if element == '': # tolerate a trailing ampersand
                 continue
             pair = self.re_pair.match(element)
@@ -278,48 +881,160 @@ class Mailtoplus():
 
 
             key, value = pair.groups()
-            if key == 'to':
+            if key.startswith(default_prefix):
+                if email:
+                    raise MalformedUriException("Defaults have to come before the first 'to='!")
+                self.__parse_field(defaults, key[len(default_prefix):], value)
+
+            elif key == 'to':
                 # file away the current email entry
                 if email:
                     emails.append(email)
-                email = {
-                    'to': self.__decode_addresses(value),
-                }
+                if len(emails) >= self.limits['max_emails']:
+                    raise MalformedUriException("More than {0} emails in one URI.".format(self.limits['max_emails']))
+                # Shallow copy: the decoded defaults are shared by reference.
+                email = dict(defaults)
+                email['to'] = self.__decode_addresses(value)
 
             else:
                 if not email:
                     raise MalformedUriException("Start each new email with 'to='!")
 
-                if key in set(["cc", "bcc"]):
-                    email[key] = self.__decode_addresses(value)
-
-                elif key in set(["subject", "body"]):
-                    email[key] = self.__decode(value)
-
-                elif key == 'attachment':
-                    try:
-                        method, source, attachmentname = value.split(',', 2)
-                        if method not in ('local', 'url'):
-                            raise MalformedAttachmentException("Attachment '%s' specifies an unknown method." % value)
-                        if not 'attachment' in email:
-                            email['attachment'] = []
-                        email['attachment'].append(
-                            {'method': method, 'source': self.__decode(source), 'attachmentname': self.__decode(attachmentname)},
-                        )
-                    except ValueError, e:
-                        raise MalformedAttachmentException("Attachment '%s' has not the expected form." % value)
-
-                else:
-                    raise MalformedUriException("Found unknown key '%s'" % key)
+                self.__parse_field(email, key, value, defaults)
 
         if email:
             emails.append(email)
         
         return emails
 
+    def __quote(self, text, safe=''):
+        if isinstance(text, unicode):
+            text = text.encode('utf-8')
+        # Refuse what parse_uri would refuse instead of building dead links.
+        if len(text) > self.limits['max_field_length']:
+            raise MalformedUriException("A value is longer than {0} bytes.".format(self.limits['max_field_length']))
+        if not self.re_unsafe.search(text):
+            return text
+        # Link generators repeat the same sources, names and subjects a lot.
+        key = (text, safe)
+        quoted = self.quoted.get(key, None)
+        if quoted is None:
+            if len(self.quoted) >= quote_cache_size:
+                self.quoted.clear()
+            quoted = self.quoted[key] = urllib.quote(text, safe)
+        return quoted
+
+    def __encode_fields(self, email, prefix='', defaults={}):
+        """Yields the key=value elements of one email (or the defaults)
+        in the order to, cc, bcc, subject, body, attachment. defaults are
+        the values the email inherits.
+        """
+        for key in ('cc', 'bcc', 'subject', 'body'):
+            # An empty value is not representable, the email would get the default.
+            if key in email and not email[key] and defaults.get(key, None):
+                raise IllegalArgumentError("An empty '{0}' cannot override the default.".format(key))
+        for key in ('to', 'cc', 'bcc'):
+            addresses = email.get(key, None)
+            if addresses:
+                if isinstance(addresses, basestring):
+                    addresses = [addresses]
+                if not all(addresses):
+                    raise IllegalArgumentError("Empty address in '{0}'.".format(key))
+                yield '{0}{1}={2}'.format(prefix, key, ','.join([self.__quote(a, '@') for a in addresses]))
+        for key in ('subject', 'body'):
+            if email.get(key, None):
+                yield '{0}{1}={2}'.format(prefix, key, self.__quote(email[key]))
+        attachments = email.get('attachment', [])
+        inherited = len(defaults.get('attachment', []))
+        if inherited + len(attachments) > self.limits['max_attachments']:
+            raise MalformedUriException("More than {0} attachments in one email.".format(
+                self.limits['max_attachments']))
+        for att in attachments:
+            if att['method'] not in ('local', 'url'):
+                raise MalformedAttachmentException("Attachment '%s' specifies an unknown method." % repr(att))
+            value = '{0},{1},{2}'.format(att['method'], self.__quote(att['source']),
+                self.__quote(att['attachmentname']))
+            if att.get('sha256', None):
+                if not self.re_digest.match(att['sha256']):
+                    raise MalformedAttachmentException("Attachment '%s' has not a SHA-256 hex digest." % repr(att))
+                value += ',sha256:' + att['sha256']
+            yield '{0}attachment={1}'.format(prefix, value)
+
+    def __iter_data(self, emails, defaults):
+        # The '&'-joined key=value elements after the scheme.
+        separator = ''
+        if defaults:
+            if 'to' in defaults:
+                raise IllegalArgumentError("Defaults cannot contain 'to'.")
+            for element in self.__encode_fields(defaults, default_prefix):
+                yield separator + element
+                separator = '&'
+        else:
+            defaults = {}
+        for count, email in enumerate(emails, 1):
+            if count > self.limits['max_emails']:
+                raise MalformedUriException("More than {0} emails in one URI.".format(self.limits['max_emails']))
+            if not email.get('to', None):
+                raise IllegalArgumentError("Each email needs at least one 'to' address.")
+            for element in self.__encode_fields(email, defaults=defaults):
+                yield separator + element
+                separator = '&'
+
+    def iter_uri(self, emails, defaults=None):
+        """Yields a mailtoplus URI for the emails in pieces, e.g. to write
+        URIs with many emails without holding them in memory. The email
+        dicts have the form parse_uri returns. defaults become 'default.'
+        keys that all emails inherit.
+        """
+        length = len(scheme) + 1
+        yield '%s:' % scheme
+        for piece in self.__iter_data(emails, defaults):
+            length += len(piece)
+            if length > self.limits['max_uri_length']:
+                raise MalformedUriException("URI is longer than {0} characters.".format(self.limits['max_uri_length']))
+            yield piece
+
+    def build_uri(self, emails, defaults=None, compress=False):
+        """Inverse of parse_uri: encodes the emails into a mailtoplus URI,
+        optionally in the compressed 'z=' form.
+        """
+        if not compress:
+            return ''.join(self.iter_uri(emails, defaults))
+        data = ''.join(self.__iter_data(emails, defaults))
+        if len(data) > self.limits['max_payload_length']:
+            raise MalformedUriException("Compressed payload inflates to more than {0} bytes.".format(
+                self.limits['max_payload_length']))
+        uri = self.compress_uri('%s:%s' % (scheme, data))
+        if len(uri) > self.limits['max_uri_length']:
+            raise MalformedUriException("URI is longer than {0} characters.".format(self.limits['max_uri_length']))
+        return uri
+
+    def iter_uris(self, batches, defaults=None, compress=False):
+        """Yields one URI per list of emails, for generating links in bulk."""
+        for emails in batches:
+            yield self.build_uri(emails, defaults, compress)
+
+    def compress_uri(self, uri):
+        """Turns a plain mailtoplus URI into the equivalent compressed form
+        'mailtoplus:z=<base64url of deflated payload>'.
+        """
+        if not uri.startswith('%s:' % scheme):
+            raise WrongSchemeException("URI has to start with '%s:'" % scheme)
+
+        rest = uri.split(":", 1)[1]
+        payload = base64.urlsafe_b64encode(zlib.compress(rest, 9)).rstrip('=')
+        return '%s:%s=%s' % (scheme, compressed_key, payload)
+
+class NoRedirectHandler(urllib2.HTTPRedirectHandler):
+    """Makes a redirect fail with HTTPError instead of following it."""
+    def redirect_request(self, req, fp, code, msg, headers, newurl):
+        return None
+
 class MailClientHandler():
-    def __init__(self, config):
+    def __init__(self, config, metrics=None):
         self.config = config
+        self.metrics = metrics if metrics else RunMetrics()
+        self.store = ContentStore(config.get_cachedir())
 
     def get_unhandled_safety_issues(self, emails):
         unhandled = {}
@@ -333,6 +1048,195 @@ class MailClientHandler():
     def generate_email(self, email):
         pass # override me
 
+    def __request(self, url):
+        # urllib2 does not recognize embedded authentication credentials,
+        # so we make that a proper Request header and cancel out the data
+        # from the URL.
+        pr = urlparse.urlparse(url)
+        pair = '{0}:{1}'.format(pr.username, pr.password)
+        if pr.username:
+            url = url.replace(pair+'@', '', 1)
+
+        req = urllib2.Request(url, None,
+            {
+                'User-Agent': 'mailtoplus/{}'.format(__version__),
+                'Accept-Encoding': accept_encoding,
+            })
+
+        if pr.username:
+            req.add_header('Authorization', 'Basic {}'.format(base64.b64encode(pair)))
+        return req
+
+    def __urlopen(self, req, ssl_insecure, redirects=True, **kwargs):
+        if not redirects:
+            handlers = [NoRedirectHandler]
+            if ssl_insecure:
+                handlers.append(urllib2.HTTPSHandler(context=ssl.SSLContext(ssl.PROTOCOL_SSLv23)))
+            return urllib2.build_opener(*handlers).open(req, **kwargs)
+        if ssl_insecure:
+            ctx = ssl.SSLContext(ssl.PROTOCOL_SSLv23)
+            return urllib2.urlopen(req, context=ctx, **kwargs)
+        return urllib2.urlopen(req, **kwargs)
+
+    def attachment_size(self, att):
+        """Bytes still to transfer for the attachment: 0 if it is staged
+        already or in the store, the file size for local files, the
+        Content-Length learned by prefetch for URLs, otherwise None.
+        """
+        if 'localsource' in att:
+            return 0
+        if 'sha256' in att and self.store.lookup(att['sha256']):
+            return 0
+        if att['method'] == 'local':
+            try:
+                return os.path.getsize(fileurl2path(att['source']))
+            except OSError:
+                return None # reported when it is staged
+        return att.get('size', None)
+
+    def await_prefetch(self, threads):
+        """Waits up to prefetch_timeout in total for the threads prefetch
+        started, so that schedule sees the sizes from HEAD requests.
+        """
+        deadline = time.time() + prefetch_timeout
+        for thread in threads:
+            thread.join(max(0, deadline - time.time()))
+
+    def schedule(self, emails):
+        """Orders the emails so the first one is composed as early as
+        possible: fewest attachments of unknown size first, then least
+        bytes to transfer, otherwise keeping the order of the URI.
+        """
+        def cost(indexed):
+            index, email = indexed
+            unknown = 0
+            known = 0
+            for att in email.get('attachment', []):
+                size = self.attachment_size(att)
+                if size is None:
+                    unknown += 1
+                else:
+                    known += size
+            return (unknown, known, index)
+        return [email for index, email in sorted(enumerate(emails), key=cost)]
+
+    def stage_local(self, path, attachmentname):
+        """Places the local file under attachmentname in the temp dir without
+        copying data if possible: hardlink, then copy-on-write clone, then
+        a chunked copy. Returns the staged filename, the way it was staged
+        and the number of bytes copied.
+        """
+        if not os.path.isfile(path):
+            raise FileNotFoundException("Local attachment {0} does not exist.".format(path))
+        filename = self.config.get_tempfilename(attachmentname)
+
+        try:
+            os.link(path, filename)
+            return filename, 'hardlink', 0
+        except OSError, e:
+            if e.errno not in (errno.EXDEV, errno.EPERM, errno.EACCES, errno.EMLINK, errno.ENOTSUP):
+                raise
+
+        try:
+            if reflink(path, filename):
+                return filename, 'reflink', 0
+        except (IOError, OSError), e:
+            logger.debug("Cloning %s failed: %s", path, e)
+
+        with open(path, 'rb') as src:
+            with open(filename, 'wb') as dst:
+                shutil.copyfileobj(src, dst, copy_chunk)
+                return filename, 'copy', dst.tell()
+
+    def prefetch(self, emails):
+        """Prepares downloads from regions that are already allowed while
+        the user still answers the safety prompts: host names are resolved
+        in the background, one thread per host. With the option
+        'prefetch_head' set to 'yes', a HEAD request also stores the
+        expected size in the attachment's 'size'. Regions that are pending
+        or forbidden are never contacted. Returns the started threads.
+        """
+        options = self.config.configuration.get('options', {})
+        if options.get('prefetch', 'yes') != 'yes':
+            return []
+        head = options.get('prefetch_head', 'no') == 'yes'
+        ssl_insecure = options.get('ssl', 'secure') == 'insecure'
+
+        hosts = {}
+        seen = set()
+        for email in emails:
+            for att in email.get('attachment', []):
+                if att['method'] != 'url' or 'localsource' in att or id(att) in seen:
+                    continue
+                if 'sha256' in att and self.store.lookup(att['sha256']):
+                    continue
+                seen.add(id(att))
+                if self.config.get_safety(att['method'], att['source']) != 'allowed':
+                    continue
+                pr = urlparse.urlparse(att['source'])
+                port = pr.port or (443 if pr.scheme.lower() == 'https' else 80)
+                atts = hosts.setdefault((pr.hostname, port), [])
+                if head:
+                    atts.append(att)
+
+        threads = []
+        for (host, port), atts in hosts.items():
+            t = threading.Thread(target=self.__prefetch_host, args=(host, port, atts, ssl_insecure),
+                name="mailtoplus-prefetch-{0}".format(host))
+            t.daemon = True
+            t.start()
+            threads.append(t)
+        return threads
+
+    def __prefetch_host(self, host, port, atts, ssl_insecure):
+        # Purely speculative, the real download reports any problem.
+        try:
+            socket.getaddrinfo(host, port, 0, socket.SOCK_STREAM)
+        except socket.error, e:
+            logger.debug("Prefetch could not resolve %s: %s", host, e)
+            return
+        for att in atts:
+            req = self.__request(att['source'])
+            req.get_method = lambda: 'HEAD'
+            try:
+                # A redirect could lead to a region that is not allowed (and
+                # urllib2 would follow it with a GET carrying the credentials).
+                r = self.__urlopen(req, ssl_insecure, redirects=False, timeout=prefetch_timeout)
+                length = r.info().getheader('Content-Length')
+                r.close()
+                if length and length.isdigit():
+                    att['size'] = int(length)
+            except (urllib2.URLError, socket.error, ssl.SSLError, httplib.HTTPException), e:
+                logger.debug("Prefetch HEAD failed for %s: %s", host, e)
+
+    def __copy(self, src, dst, digest, decoder):
+        """Copies in chunks, decoding and feeding the digest on the way.
+        Returns the bytes read and written.
+        """
+        wire = 0
+        disk = 0
+        while True:
+            chunk = src.read(copy_chunk)
+            wire += len(chunk)
+            for data in decoder.decompress(chunk) if chunk else [decoder.flush()]:
+                digest.update(data)
+                dst.write(data)
+                disk += len(data)
+            if not chunk:
+                return wire, disk
+
+    def __hash_file(self, filename):
+        digest = hashlib.sha256()
+        with open(filename, 'rb') as f:
+            for chunk in iter(lambda: f.read(copy_chunk), ''):
+                digest.update(chunk)
+        return digest.hexdigest()
+
+    def __verify(self, att, hexdigest):
+        if hexdigest != att['sha256']:
+            raise DownloadException("Content of {0} has SHA-256 {1}, expected {2}.".format(
+                att['source'], hexdigest, att['sha256']))
+
     def download_attachments(self, email):
         # Download non-local sources to temporary location.
         # Regardless of source, places 'localsource' in email['attachment'][]
@@ -340,39 +1244,51 @@ class MailClientHandler():
         try:
             ssl_insecure = ('insecure' == self.config.configuration.get('options', {}).get('ssl', 'secure'))
             for att in email.get('attachment', []):
+                if 'localsource' in att:
+                    # Shared with an email handled before (see 'default.').
+                    self.metrics.count_shared()
+                    continue
                 if att['method'] == 'local':
-                    att['localsource'] = att['source']
+                    started = time.time()
+                    att['localsource'], how, copied = self.stage_local(fileurl2path(att['source']), att['attachmentname'])
+                    seconds = time.time() - started
+                    self.metrics.observe('stage_local', seconds)
+                    logger.info("Staged %s as %s by %s, %d bytes copied in %.3f s.",
+                        att['source'], att['localsource'], how, copied, seconds)
+                    if 'sha256' in att:
+                        self.__verify(att, self.__hash_file(att['localsource']))
                 elif att['method'] == 'url':
-                    url = att['source']
+                    if 'sha256' in att:
+                        stored = self.store.lookup(att['sha256'])
+                        self.metrics.count_cache(bool(stored))
+                        if stored:
+                            att['localsource'] = self.stage_local(stored, att['attachmentname'])[0]
+                            logger.info("Took %s from the store, no download.", att['source'])
+                            continue
 
-                    # urllib2 does not recognize embedded authentication credentials,
-                    # so we make that a proper Request header and cancel out the data
-                    # from the URL.
-                    pr = urlparse.urlparse(url)
-                    pair = '{0}:{1}'.format(pr.username, pr.password)
-                    if pr.username:
-                        url = url.replace(pair+'@', '', 1)
-
-                    req = urllib2.Request(url, None,
-                        {
-                            'User-Agent': 'mailtoplus/{}'.format(__version__),
-                        })
-
-                    if pr.username:
-                        req.add_header('Authorization', 'Basic {}'.format(base64.b64encode(pair)))
+                    req = self.__request(att['source'])
 
                     try:
-                        if ssl_insecure:
-                            ctx = ssl.SSLContext(ssl.PROTOCOL_SSLv23)
-                            r = urllib2.urlopen(req, context=ctx)
-                        else:
-                            r = urllib2.urlopen(req)
+                        started = time.time()
+                        r = self.__urlopen(req, ssl_insecure)
 
                         filename = self.config.get_tempfilename(att['attachmentname'])
 
+                        decoder = ContentDecoder(r.info().getheader('Content-Encoding'))
+                        digest = hashlib.sha256()
                         with open(filename, 'w+b') as fp:
                             att['localsource'] = filename
-                            shutil.copyfileobj(r, fp)
+                            wire, disk = self.__copy(r, fp, digest, decoder)
+                        seconds = time.time() - started
+                        self.metrics.add_download(self.config.get_region('url', att['source']), wire, seconds)
+                        logger.info("Downloaded %s in %.3f s: %d bytes on the wire (%s), %d bytes on disk.",
+                            att['source'], seconds, wire, decoder.encoding, disk)
+                        if 'sha256' in att:
+                            self.__verify(att, digest.hexdigest())
+                            try:
+                                self.store.add(filename, att['sha256'])
+                            except (IOError, OSError), e: # the store is only a cache
+                                logger.warning("Could not add %s to the store: %s", att['source'], e)
                     except urllib2.URLError, e:
                         if "CERTIFICATE_VERIFY_FAILED" in str(e.reason):
                             if ssl_insecure:
@@ -500,61 +1416,86 @@ def popup(message):
     tkMessageBox.showinfo(message, message)
 
 def handle_emails_macos_mailapp(uri):
-    mailtoplus = Mailtoplus()
+    start_logging()
     config = ConfigManager()
     try:
         config.load_configuration(config.default_location())
     except IOError:
         config.clear()
     config.setup_logging()
+    mailtoplus = Mailtoplus(config.get_limits())
 
+    metrics = RunMetrics()
+    started = time.time()
+    prompted = 0.0 # waiting for the user, excluded from first_email and total
     try:
-        emails = mailtoplus.parse_uri(uri)
-    except Exception, e:
-        msg = "Parser failed for %s, original exception: %s" % (repr(uri), str(e))
-        logger.critical(msg)
-        raise Exception(msg)
-    mailapp = MailAppHandler(config)
-
-    unhandled = mailapp.get_unhandled_safety_issues(emails)
-    for issue, att in unhandled.items():
-        allow_now = tkMessageBox.askquestion("Authorize file attachment",
-            "The link wants to attach a file from '{0}'. Allow that?".format(issue),
-            icon='warning')
-        remember = tkMessageBox.askquestion("Remember that decision?",
-            "Should this decision be stored for future links?",
-            icon='warning')
-
-        if remember == 'yes':
-            config.set_safety(att['method'], att['source'], 'allowed' if allow_now == 'yes' else 'forbidden')
-            config.save_configuration(config.default_location())
-
-        if allow_now != 'yes':
-            # Abort processing.
-            return
+        try:
+            with metrics.timed('parse'):
+                emails = mailtoplus.parse_uri(uri)
+        except Exception, e:
+            metrics.count_error(e)
+            msg = "Parser failed for %s, original exception: %s" % (repr(uri), str(e))
+            logger.critical(msg)
+            raise Exception(msg)
+        mailapp = MailAppHandler(config, metrics)
 
-    for email in emails:
         try:
-            mailapp.download_attachments(email)
-            mailapp.generate_email(email)
-        except:
-            logger.exception("Download or Generate failed.")
-            popup("Exception: %s" % traceback.format_exc())
+            with metrics.timed('safety'): # not the prompts, they measure the user
+                unhandled = mailapp.get_unhandled_safety_issues(emails)
+                prefetching = mailapp.prefetch(emails)
+            for issue, att in unhandled.items():
+                asked = time.time()
+                allow_now = tkMessageBox.askquestion("Authorize file attachment",
+                    "The link wants to attach a file from '{0}'. Allow that?".format(issue),
+                    icon='warning')
+                remember = tkMessageBox.askquestion("Remember that decision?",
+                    "Should this decision be stored for future links?",
+                    icon='warning')
+                prompted += time.time() - asked
+
+                if remember == 'yes':
+                    config.set_safety(att['method'], att['source'], 'allowed' if allow_now == 'yes' else 'forbidden')
+                    config.save_configuration(config.default_location())
+
+                if allow_now != 'yes':
+                    # Abort processing.
+                    return
+
+            mailapp.await_prefetch(prefetching)
+            for email in mailapp.schedule(emails):
+                try:
+                    with metrics.timed('download'):
+                        mailapp.download_attachments(email)
+                    with metrics.timed('generate'):
+                        mailapp.generate_email(email)
+                    if 'first_email' not in metrics.latencies:
+                        metrics.observe('first_email', time.time() - started - prompted)
+                except:
+                    logger.exception("Download or Generate failed.")
+                    popup("Exception: %s" % traceback.format_exc())
+                    raise
+        except Exception, e:
+            metrics.count_error(e)
             raise
 
-    time.sleep(10) # give Mail.app time to grab attachments
+        metrics.observe('total', time.time() - started - prompted)
+
+        time.sleep(10) # give Mail.app time to grab attachments
 
-    if len(emails) > 1:
-        popup('{0} emails created successfully!'.format(len(emails)))
+        if len(emails) > 1:
+            popup('{0} emails created successfully!'.format(len(emails)))
 
-    call(['logger', 'Mailtoplus finished {0} emails successfully. Version {1} {2} running with sys.argv: {3}'.format(
-        len(emails), __version__, __date__, str(sys.argv)
-        )])
+        syslog_this('Mailtoplus finished {0} emails successfully. Version {1} {2} running with sys.argv: {3}'.format(
+            len(emails), __version__, __date__, str(sys.argv)
+            ))
 
-    config.cleanup_tempdir()
+        config.cleanup_tempdir()
+    finally:
+        record_metrics(config, metrics)
 
 def syslog_this(message):
-    call(['logger', message])
+    start_logging()
+    syslogger.info(message)
 
 if __name__ == '__main__':
     if len(sys.argv) == 1: